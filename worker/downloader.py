@@ -1,46 +1,51 @@
-from firebase_admin import storage, initialize_app
-from io import BytesIO
+from firebase_admin import storage
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import count
 from PIL import Image, UnidentifiedImageError
-from multiprocessing import current_process
-from tempfile import NamedTemporaryFile
+from tempfile import TemporaryFile
+import threading
 
-if current_process().name != 'MainProcess':
-    print('Child process started')
-    cnt = 0
-    initialize_app()
+download_counter = count(1)
+
+# Downloads run ahead of tagging, so cap how many are in flight or decoded but not yet
+# consumed; each decoded image takes about 0.5 MB
+MAX_PENDING_DOWNLOADS = 16
 
 def download_image(image_id: str):
-    global cnt
-    cnt += 1
+    cnt = next(download_counter)
 
     print(f'Start download_image: {image_id} (cnt = {cnt})')
 
     bucket = storage.bucket('danbooru-ml-classifier-images')
     image_file = bucket.blob(image_id)
-    image_bytes_io = BytesIO()
-    image_file.download_to_file(image_bytes_io)
-    image_bytes_io.seek(0)
-
-    print(f'Image downloaded: {image_id}')
-
-    try:
-        image = Image.open(image_bytes_io)
-    except UnidentifiedImageError as e:
-        print(f'Error opening image: {e}')
-        return None
 
-    print(f'Image opened: {image_id}')
-
-    # Resize the image so that the shorter side is 360 pixels
-    width, height = image.size
-    if width < height:
-        new_width = 360
-        new_height = int(new_width * height / width)
-    else:
-        new_height = 360
-        new_width = int(new_height * width / height)
-
-    image = image.resize((new_width, new_height), Image.BILINEAR)
+    # Stream the blob to an anonymous temporary file instead of growing an
+    # in-memory buffer next to the decoded image
+    with TemporaryFile() as image_raw_file:
+        image_file.download_to_file(image_raw_file)
+        image_raw_file.seek(0)
+
+        print(f'Image downloaded: {image_id}')
+
+        try:
+            image = Image.open(image_raw_file)
+        except UnidentifiedImageError as e:
+            print(f'Error opening image: {e}')
+            return None
+
+        print(f'Image opened: {image_id}')
+
+        # Resize the image so that the shorter side is 360 pixels.
+        # This decodes the image, so it must happen before the file is closed.
+        width, height = image.size
+        if width < height:
+            new_width = 360
+            new_height = int(new_width * height / width)
+        else:
+            new_height = 360
+            new_width = int(new_height * width / height)
+        image = image.resize((new_width, new_height), Image.BILINEAR)
 
     print(f'Image resized: {image_id}')
 
@@ -51,20 +56,44 @@ def download_image(image_id: str):
         print('Image conversion failed')
         print(e)
 
-    with NamedTemporaryFile(delete=False) as temp:
-        image.save(temp, format='JPEG', quality=100, subsampling=0)
-        output_path = temp.name
+    # The image is handed to inference in memory, so there is no need to
+    # re-encode it as JPEG and decode it again from a temporary file
+    return image
 
-    print(f'Image saved: {image_id}')
+def call_when_done(futures: list, callback):
+    # Calls the callback from the thread that completes the last of the futures
+    remaining_futures = [len(futures)]
+    remaining_futures_lock = threading.Lock()
 
-    return output_path
+    def on_done(_):
+        with remaining_futures_lock:
+            remaining_futures[0] -= 1
+            if remaining_futures[0] > 0:
+                return
+        callback()
 
-def download_images(image_ids: list):
-    from multiprocessing import Pool
+    if len(futures) == 0:
+        callback()
+    for future in futures:
+        future.add_done_callback(on_done)
 
+def download_images(image_ids: list, on_downloaded=None):
     print('Start download_images')
-    with Pool(processes=8, maxtasksperchild=1) as p:
-        results = p.map(download_image, image_ids)
-    print('End download_images')
-
-    return results
\ No newline at end of file
+    # Downloading is I/O-bound and Pillow releases the GIL while decoding and
+    # resizing, so threads avoid the cost of forking a process per image
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        pending_downloads = deque()
+        for image_id in image_ids:
+            if len(pending_downloads) >= MAX_PENDING_DOWNLOADS:
+                yield pending_downloads.popleft().result()
+            pending_downloads.append(executor.submit(download_image, image_id))
+
+        # Every download has been submitted, so the last pending one to finish ends the downloads
+        if on_downloaded is not None:
+            call_when_done(list(pending_downloads), on_downloaded)
+
+        # Yield each image as soon as it is ready so that the caller can run
+        # inference while the remaining images are still being downloaded
+        while len(pending_downloads) > 0:
+            yield pending_downloads.popleft().result()
+    print('End download_images')
\ No newline at end of file
@@ -1,165 +1,353 @@
 from firebase_functions import firestore_fn, options
 from firebase_admin import initialize_app, storage, firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
 from joblib import load
-from PIL import Image, UnidentifiedImageError
+from tempfile import TemporaryFile
+import sklearn
 import torch
 from torchvision import models
 from danbooru_resnet import _resnet
-from tagger import get_raw_tags
+from tagger import get_raw_tags_batch
 from downloader import download_images
 from torch_network import get_torch_network
 import json
 from urllib.request import urlopen
-import os
+import threading
+import time
 
 initialize_app()
 
-preference_linear_svc_model = None
-preference_ada_boost_model = None
-preference_torch_network_model = None
-deepdanbooru_model = None
-class_names = None
+# Tags are sigmoid outputs, so sklearn's NaN/inf scan of every input is wasted work
+sklearn.set_config(assume_finite=True)
+
+models_lock = threading.Lock()
+
+PREFERENCE_CLASSES = ('not_bookmarked', 'bookmarked_public', 'bookmarked_private')
+
+# Sized to keep ResNet-50 activations well within the 2 GB memory limit
+TAGGING_BATCH_SIZE = 4
+
+# Firestore accepts up to 500 writes per batch, but flushing more often keeps
+# finished results from being lost if the function times out mid-run.
+UPDATE_BATCH_SIZE = 50
+
+CLASS_NAMES_URL = 'https://github.com/RF5/danbooru-pretrained/raw/master/config/class_names_6000.json'
+
+# Decoded images take about 0.5 MB each, so at most this many stale images are prefetched
+PREFETCH_LIMIT = 32
+
+# Batch commits run in the background so that Firestore latency overlaps with inference
+commit_executor = ThreadPoolExecutor(max_workers=8)
+
+# Downloads images for the second pass of onImageCreated while the first pass is tagged
+prefetch_executor = ThreadPoolExecutor(max_workers=1)
+
+@lru_cache(maxsize=1)
+def get_db():
+    return firestore.client()
 
 def get_rss():
     import resource
     rusage = resource.getrusage(resource.RUSAGE_SELF)
     return rusage.ru_maxrss
 
-def get_preference_linear_svc_model():
-    bucket = storage.bucket('danbooru-ml-classifier')
-    model_file = bucket.blob('preference/sklearn-multiclass-linear-svc.joblib')
-    model_bytes_io = BytesIO()
-    model_file.download_to_file(model_bytes_io)
-    model_bytes_io.seek(0)
-
-    model = load(model_bytes_io)
-
+@contextmanager
+def measure(stage_times: dict, stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_times[stage] += time.perf_counter() - start
+
+def measure_iter(iterable, stage_times: dict, stage: str):
+    # Accounts the time spent waiting for each item, e.g. for a download to finish
+    iterator = iter(iterable)
+    while True:
+        with measure(stage_times, stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+@lru_cache(maxsize=1)
+def get_model_bucket():
+    return storage.bucket('danbooru-ml-classifier')
+
+def download_model_file(blob_name: str):
+    # Stream the blob to an anonymous temporary file instead of an in-memory buffer;
+    # the file is deleted as soon as the model has been loaded from it
+    model_file = TemporaryFile()
+    get_model_bucket().blob(blob_name).download_to_file(model_file)
+    model_file.seek(0)
+    print(f'Model file downloaded: {blob_name}')
+    return model_file
+
+def load_sklearn_model(blob_name: str):
+    with download_model_file(blob_name) as model_file:
+        return load(model_file)
+
+def load_torch_model(blob_name: str, model: torch.nn.Module):
+    with download_model_file(blob_name) as model_file:
+        model.load_state_dict(torch.load(model_file, map_location=torch.device('cpu')))
     return model
 
-def get_preference_ada_boost_model():
-    bucket = storage.bucket('danbooru-ml-classifier')
-    model_file = bucket.blob('preference/sklearn-multiclass-ada-boost.joblib')
-    model_bytes_io = BytesIO()
-    model_file.download_to_file(model_bytes_io)
-    model_bytes_io.seek(0)
-
-    model = load(model_bytes_io)
+def get_preference_linear_svc_model():
+    return load_sklearn_model('preference/sklearn-multiclass-linear-svc.joblib')
 
-    return model
+def get_preference_ada_boost_model():
+    return load_sklearn_model('preference/sklearn-multiclass-ada-boost.joblib')
 
 def get_preference_torch_network_model():
-    bucket = storage.bucket('danbooru-ml-classifier')
-    model_file = bucket.blob('preference/torch-multiclass-onehot-shallow-network-multilayer')
-    model_bytes_io = BytesIO()
-    model_file.download_to_file(model_bytes_io)
-    model_bytes_io.seek(0)
+    model = load_torch_model('preference/torch-multiclass-onehot-shallow-network-multilayer', get_torch_network())
+
+    model.eval()
 
-    model = get_torch_network()
-    model.load_state_dict(torch.load(model_bytes_io, map_location=torch.device('cpu')))
+    # Script and freeze the network so that a forward pass runs as one graph
+    # instead of dispatching each layer from Python
+    model = torch.jit.freeze(torch.jit.script(model))
 
     return model
 
 def get_deepdanbooru_model():
-    bucket = storage.bucket('danbooru-ml-classifier')
-    model_file = bucket.blob('deepdanbooru/0.1/resnet50-13306192.pth')
-    model_bytes_io = BytesIO()
-    model_file.download_to_file(model_bytes_io)
-    model_bytes_io.seek(0)
-
-    model = _resnet(models.resnet50, 6000)
-    model.load_state_dict(torch.load(model_bytes_io, map_location=torch.device('cpu')))
+    model = load_torch_model('deepdanbooru/0.1/resnet50-13306192.pth', _resnet(models.resnet50, 6000))
 
     model.eval()
 
-    return model
+    # Compile to TorchScript, freeze it so that the weights become constants and
+    # BatchNorm layers are folded into the preceding convolutions, and switch the
+    # convolutions to MKLDNN kernels
+    model = torch.jit.optimize_for_inference(torch.jit.script(model))
 
-def get_top_tag_probs(tag_probs: torch.Tensor, threshold = 0.05):
-    global class_names
+    return model
 
-    if class_names is None:
-        print('Loading class names...')
-        with urlopen("https://github.com/RF5/danbooru-pretrained/raw/master/config/class_names_6000.json") as url:
-            class_names = json.loads(url.read().decode())
-        print('Done loading class names')
-    else:
-        print('Class names already loaded')
+@lru_cache(maxsize=1)
+def get_class_names():
+    print('Loading class names...')
+    with urlopen(CLASS_NAMES_URL) as url:
+        class_names = tuple(json.loads(url.read().decode()))
+    print('Done loading class names')
 
-    tmp = tag_probs[tag_probs > threshold]
-    inds = tag_probs.argsort(descending=True)
-    tag_dict = {}
-    for i in inds[0:len(tmp)]:
-        tag_dict[class_names[i]] = tag_probs[i].numpy()[()].item()
+    return class_names
 
-    return tag_dict
+def get_top_tag_probs(tag_probs: torch.Tensor, threshold = 0.05):
+    class_names = get_class_names()
 
-def inference_list_to_dict(inference_list: list):
-    return dict(zip(
-        ['not_bookmarked', 'bookmarked_public', 'bookmarked_private'],
-        inference_list
-    ))
-
-def infer_image_preference(image_id: str, image_path: str):
-    global preference_linear_svc_model, preference_ada_boost_model, preference_torch_network_model, deepdanbooru_model
-
-    print(f'Infering image: {image_id} (mem = {get_rss()})')
-
-    if deepdanbooru_model is None:
-        deepdanbooru_model = get_deepdanbooru_model()
-        print(f'DeepDanbooru model loaded (mem = {get_rss()})')
-        print(deepdanbooru_model)
-
-    if preference_linear_svc_model is None:
-        preference_linear_svc_model = get_preference_linear_svc_model()
-        print(f'Preference LinearSVC model loaded (mem = {get_rss()})')
-        print(preference_linear_svc_model)
-
-    if preference_ada_boost_model is None:
-        preference_ada_boost_model = get_preference_ada_boost_model()
-        print(f'Preference AdaBoost model loaded (mem = {get_rss()})')
-        print(preference_ada_boost_model)
-
-    if preference_torch_network_model is None:
-        preference_torch_network_model = get_preference_torch_network_model()
-        print(f'Preference Torch Network model loaded (mem = {get_rss()})')
-        print(preference_torch_network_model)
-
-    with open(image_path, 'rb') as image_file:
-        try:
-            image = Image.open(image_file)
-        except UnidentifiedImageError as e:
-            print(f'Error opening image: {e}')
-            return
-
-        print(f'Image opened: {image_id}')
-        tags = get_raw_tags(deepdanbooru_model, image)
-
-    os.remove(image_path)
-
-    top_tag_probs = get_top_tag_probs(tags)
-    print(f'Top tag probs inferred: {image_id}')
-
-    linear_svc_preference = preference_linear_svc_model.decision_function(tags.numpy().reshape(1, -1))
-    print(f'LinearSVC preference inferred: {image_id}')
-    ada_boost_preference = preference_ada_boost_model.decision_function(tags.numpy().reshape(1, -1))
-    print(f'AdaBoost preference inferred: {image_id}')
-    torch_network_preference = preference_torch_network_model(tags)
-    print(f'Torch Network preference inferred: {image_id}')
+    # Filter and sort in torch, then convert the few surviving entries to Python in bulk
+    indices = torch.nonzero(tag_probs > threshold, as_tuple=True)[0]
+    probs = tag_probs[indices]
+    order = probs.argsort(descending=True)
 
     return {
-        'top_tag_probs': top_tag_probs,
-        'inferences': {
-            'sklearn_multiclass_linear_svc': inference_list_to_dict(linear_svc_preference.tolist()[0]),
-            'sklearn_multiclass_ada_boost': inference_list_to_dict(ada_boost_preference.tolist()[0]),
-            'torch_multiclass_onehot_shallow_network_multilayer': inference_list_to_dict(torch_network_preference.tolist()),
-        },
+        class_names[i]: prob
+        for i, prob in zip(indices[order].tolist(), probs[order].tolist())
     }
 
+def inference_list_to_dict(inference_list: list):
+    return dict(zip(PREFERENCE_CLASSES, inference_list))
+
+@lru_cache(maxsize=1)
+def get_models():
+    print(f'Loading models (mem = {get_rss()})')
+
+    # Loading is dominated by independent GCS downloads, so run the loaders concurrently
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        deepdanbooru_future = executor.submit(get_deepdanbooru_model)
+        linear_svc_future = executor.submit(get_preference_linear_svc_model)
+        ada_boost_future = executor.submit(get_preference_ada_boost_model)
+        torch_network_future = executor.submit(get_preference_torch_network_model)
+
+    deepdanbooru_model = deepdanbooru_future.result()
+    print(f'DeepDanbooru model loaded (mem = {get_rss()})')
+    print(deepdanbooru_model)
+
+    preference_linear_svc_model = linear_svc_future.result()
+    print(f'Preference LinearSVC model loaded (mem = {get_rss()})')
+    print(preference_linear_svc_model)
+
+    preference_ada_boost_model = ada_boost_future.result()
+    print(f'Preference AdaBoost model loaded (mem = {get_rss()})')
+    print(preference_ada_boost_model)
+
+    preference_torch_network_model = torch_network_future.result()
+    print(f'Preference Torch Network model loaded (mem = {get_rss()})')
+    print(preference_torch_network_model)
+
+    return deepdanbooru_model, preference_linear_svc_model, preference_ada_boost_model, preference_torch_network_model
+
+def load_models():
+    # lru_cache does not stop concurrent first calls from each running the loaders,
+    # so serialize them to avoid downloading the models twice
+    with models_lock:
+        return get_models()
+
+def infer_image_tags(image_ids: list, images: list):
+    print(f'Infering images: {", ".join(image_ids)} (mem = {get_rss()})')
+
+    deepdanbooru_model, _, _, _ = load_models()
+
+    return get_raw_tags_batch(deepdanbooru_model, images)
+
+def infer_image_preferences(tags_batch: torch.Tensor):
+    _, preference_linear_svc_model, preference_ada_boost_model, preference_torch_network_model = load_models()
+
+    # Predict the whole batch at once, since per-sample calls are dominated by
+    # input validation and dispatch overhead rather than by the actual math
+    tags_array = tags_batch.numpy()
+
+    # The LinearSVC decision function is a single 6000x3 matrix product, so compute it
+    # directly; the float64 coefficients keep the scores identical to decision_function
+    linear_svc_preferences = tags_array @ preference_linear_svc_model.coef_.T + preference_linear_svc_model.intercept_
+    print(f'LinearSVC preferences inferred: {len(tags_array)}')
+    ada_boost_preferences = preference_ada_boost_model.decision_function(tags_array)
+    print(f'AdaBoost preferences inferred: {len(tags_array)}')
+    with torch.no_grad():
+        torch_network_preferences = preference_torch_network_model(tags_batch)
+    print(f'Torch Network preferences inferred: {len(tags_array)}')
+
+    return [
+        {
+            'sklearn_multiclass_linear_svc': inference_list_to_dict(linear_svc_preference),
+            'sklearn_multiclass_ada_boost': inference_list_to_dict(ada_boost_preference),
+            'torch_multiclass_onehot_shallow_network_multilayer': inference_list_to_dict(torch_network_preference),
+        }
+        for linear_svc_preference, ada_boost_preference, torch_network_preference in zip(
+            linear_svc_preferences.tolist(),
+            ada_boost_preferences.tolist(),
+            torch_network_preferences.tolist(),
+        )
+    ]
+
+def commit_updates(db: firestore.Client, updates: list, commits: list):
+    for i in range(0, len(updates), UPDATE_BATCH_SIZE):
+        batch = db.batch()
+        for reference, data in updates[i:i + UPDATE_BATCH_SIZE]:
+            batch.update(reference, data)
+        commits.append(commit_executor.submit(batch.commit))
+    print(f'Queued updates: {len(updates)}')
+    updates.clear()
+
+def wait_commits(commits: list):
+    for commit in commits:
+        # Blocks until the batch is written and re-raises its error if any
+        commit.result()
+    print(f'Committed batches: {len(commits)}')
+    commits.clear()
+
+def prefetch_images(image_ids: list):
+    # Downloads in the background and returns a future of {image_id: image}
+    return prefetch_executor.submit(lambda: dict(zip(image_ids, download_images(image_ids))))
+
+def process_images(db: firestore.Client, images: list, prefetched_images: dict = None, on_downloaded=None):
+    # Read the key once per snapshot and reuse it for both download and logging
+    image_ids = [image.get('key') for image in images]
+    stage_times = defaultdict(float)
+
+    updates = []
+    commits = []
+
+    tagged_images = []
+    tagged_image_tags = []
+
+    if prefetched_images is None:
+        prefetched_images = {}
+
+    # Take prefetched images where available and download the rest
+    missing_image_ids = [image_id for image_id in image_ids if image_id not in prefetched_images]
+    downloads = download_images(missing_image_ids, on_downloaded)
+    if len(missing_image_ids) == 0 and on_downloaded is not None:
+        on_downloaded()
+
+    def get_downloaded_images():
+        timed_downloads = measure_iter(downloads, stage_times, 'download')
+        for image_id in image_ids:
+            if image_id in prefetched_images:
+                # Drop the reference so that the image can be freed once it is tagged
+                yield prefetched_images.pop(image_id)
+            else:
+                yield next(timed_downloads)
+
+    downloaded_images = get_downloaded_images()
+
+    def flush_tagged_images():
+        # Run the preference models on a stack of tag vectors and queue the results right
+        # away, so that a timeout loses at most one chunk of finished images
+        with measure(stage_times, 'preference'):
+            preferences = infer_image_preferences(torch.stack(tagged_image_tags))
+
+        for image, tags, inferences in zip(tagged_images, tagged_image_tags, preferences):
+            updates.append((image.reference, {
+                'status': 'inferred',
+                'topTagProbs': get_top_tag_probs(tags),
+                'inferences': inferences,
+            }))
+        tagged_images.clear()
+        tagged_image_tags.clear()
+
+        with measure(stage_times, 'commit'):
+            commit_updates(db, updates, commits)
+
+    def tag_bucket(bucket: list):
+        bucket_images, bucket_image_ids, bucket_downloaded_images = zip(*bucket)
+        with measure(stage_times, 'tagging'):
+            tags_batch = infer_image_tags(list(bucket_image_ids), list(bucket_downloaded_images))
+        print(f'Tags inferred: {len(bucket)}')
+
+        tagged_images.extend(bucket_images)
+        tagged_image_tags.extend(tags_batch)
+        bucket.clear()
+
+        if len(tagged_images) >= UPDATE_BATCH_SIZE:
+            flush_tagged_images()
+
+    # Only images of the same size can share a DeepDanbooru forward pass. A batch is
+    # tagged as soon as it is full or the next image has another size, so that tagging
+    # keeps overlapping with the remaining downloads instead of waiting for all of them
+    bucket = []
+
+    for image, image_id, downloaded_image in zip(images, image_ids, downloaded_images):
+        if downloaded_image is None:
+            print(f'Error downloading image: {image_id}')
+            updates.append((image.reference, {
+                'status': 'error',
+            }))
+            continue
+
+        print(f'Processing image: {image_id}')
+
+        if len(bucket) > 0 and bucket[0][2].size != downloaded_image.size:
+            tag_bucket(bucket)
+
+        bucket.append((image, image_id, downloaded_image))
+        if len(bucket) >= TAGGING_BATCH_SIZE:
+            tag_bucket(bucket)
+
+    # zip() stops on images before asking for another download, so shut the download
+    # pool down here; this also waits for on_downloaded to return in its thread
+    downloads.close()
+
+    if len(bucket) > 0:
+        tag_bucket(bucket)
+
+    if len(tagged_images) > 0:
+        flush_tagged_images()
+
+    with measure(stage_times, 'commit'):
+        commit_updates(db, updates, commits)
+        # Callers re-query by status afterwards, so every update must be written before returning
+        wait_commits(commits)
+
+    print('Stage times: ' + ', '.join(f'{stage} = {seconds:.2f}s' for stage, seconds in stage_times.items()))
+
 @firestore.transactional
 def update_status_processing(transaction: firestore.Transaction):
-    db = firestore.client()
-    pending_images_iter = db.collection('images').where(filter=FieldFilter('status', '==', 'pending')).stream(transaction=transaction)
+    db = get_db()
+    # The rest of the pipeline reads only the key and the reference of each image
+    pending_images_iter = db.collection('images').where(filter=FieldFilter('status', '==', 'pending')).select(['key']).stream(transaction=transaction)
     pending_images = list(pending_images_iter)
     for image in pending_images:
         transaction.update(image.reference, {
@@ -174,9 +362,10 @@ def update_status_processing(transaction: firestore.Transaction):
     document='images/{image_id}',
 )
 def onImageCreated(event: firestore_fn.Event[firestore_fn.DocumentSnapshot]):
-    db = firestore.client()
+    db = get_db()
+    images_ref = db.collection('images')
 
-    pending_count_result = db.collection('images').where(filter=FieldFilter('status', '==', 'pending')).count().get()
+    pending_count_result = images_ref.where(filter=FieldFilter('status', '==', 'pending')).count().get()
     pending_count = pending_count_result[0][0].value
     print(f'Pending count: {pending_count}')
     if pending_count < 100:
@@ -186,72 +375,30 @@ def onImageCreated(event: firestore_fn.Event[firestore_fn.DocumentSnapshot]):
     pending_images = update_status_processing(transaction)
     print(f'Got pending images: {len(pending_images)}')
 
-    processing_images_iter = db.collection('images').where(filter=FieldFilter('status', '==', 'processing')).stream()
+    # Only the key is needed to remember which images were processing
+    processing_images_iter = images_ref.where(filter=FieldFilter('status', '==', 'processing')).select(['key']).stream()
     processing_image_ids = set(processing_image.to_dict()['key'] for processing_image in processing_images_iter)
     print(f'Processing images: {len(processing_image_ids)}')
 
-    pending_image_paths = download_images([image.to_dict()['key'] for image in pending_images])
-
-    for image, image_path in zip(pending_images, pending_image_paths):
-        if image_path is None:
-            print(f'Error downloading image: {image_id}')
-            image.reference.update({
-                'status': 'error',
-            })
-            continue
-
-        image_data = image.to_dict()
-        image_id = image_data['key']
-        print(f'Image created: {image_id}')
+    # Images left processing by earlier runs are the only candidates for the second pass,
+    # so start downloading some of them as soon as the first pass has downloaded its own images
+    pending_image_ids = set(image.get('key') for image in pending_images)
+    stale_image_ids = [image_id for image_id in processing_image_ids if image_id not in pending_image_ids][:PREFETCH_LIMIT]
+    stale_images_futures = []
 
-        inferences = infer_image_preference(image_id, image_path)
-        print(f'Inferred: {image_id}')
+    def prefetch_stale_images():
+        print(f'Prefetching stale images: {len(stale_image_ids)}')
+        stale_images_futures.append(prefetch_images(stale_image_ids))
 
-        if inferences is None:
-            print(f'Error inferring image: {image_id}')
-            image.reference.update({
-                'status': 'error',
-            })
-            continue
-
-        image.reference.update({
-            'status': 'inferred',
-            'topTagProbs': inferences['top_tag_probs'],
-            'inferences': inferences['inferences'],
-        })
+    process_images(db, pending_images, on_downloaded=prefetch_stale_images)
 
-    new_processing_images_iter = db.collection('images').where(filter=FieldFilter('status', '==', 'processing')).stream()
+    new_processing_images_iter = images_ref.where(filter=FieldFilter('status', '==', 'processing')).select(['key']).stream()
     new_processing_images = list(new_processing_images_iter)
     print(f'New processing images: {len(new_processing_images)}')
 
-    new_processing_image_paths = download_images([image.to_dict()['key'] for image in new_processing_images])
-
-    for image, image_path in zip(new_processing_images, new_processing_image_paths):
-        if image_path is None:
-            print(f'Error downloading image: {image_id}')
-            image.reference.update({
-                'status': 'error',
-            })
-            continue
-
-        image_data = image.to_dict()
-        image_id = image_data['key']
-        if image_id not in processing_image_ids:
-            continue
-        print(f'Image still processing: {image_id}')
-
-        inferences = infer_image_preference(image_id, image_path)
-        print(f'Inferred: {image_id}')
-
-        if inferences is None:
-            print(f'Error inferring image: {image_id}')
-            image.reference.update({
-                'status': 'error',
-            })
-            continue
+    # Retry only the images that were already processing when this run started
+    # and have not been finished since then by any invocation
+    still_processing_images = [image for image in new_processing_images if image.get('key') in processing_image_ids]
+    print(f'Images still processing: {len(still_processing_images)}')
 
-        image.reference.update({
-            'status': 'inferred',
-            'topTagProbs': inferences['top_tag_probs'],
-            'inferences': inferences['inferences'],
-        })
\ No newline at end of file
+    process_images(db, still_processing_images, stale_images_futures[0].result())
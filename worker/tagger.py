@@ -1,31 +1,18 @@
 import torch
 from torchvision import transforms
 
-def get_raw_tags(model, input_image):
-    print('Start get_raw_tags')
+PREPROCESS = transforms.Compose([
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.7137, 0.6628, 0.6519], std=[0.2970, 0.3017, 0.2979]),
+])
 
-    preprocess = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.7137, 0.6628, 0.6519], std=[0.2970, 0.3017, 0.2979]),
-    ])
+def get_raw_tags_batch(model, input_images):
+    # All images must have the same size so that they can be stacked into one batch
+    print(f'Start get_raw_tags_batch: {len(input_images)}')
 
-    print('Preprocess initialized')
-
-    input_tensor = preprocess(input_image)
-
-    print('Image preprocessed')
-
-    input_batch = input_tensor.unsqueeze(0)
-
-    print('Image unsqueezed')
+    input_batch = torch.stack([PREPROCESS(input_image) for input_image in input_images])
 
     with torch.no_grad():
         output = model(input_batch)
 
-    print('Output got')
-
-    probs = torch.sigmoid(output[0])
-
-    print('Probs got')
-
-    return probs
\ No newline at end of file
+    return torch.sigmoid(output)
\ No newline at end of file